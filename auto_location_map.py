@@ -1,13 +1,24 @@
 import argparse
-from itertools import chain
-from math import inf, pi, sqrt, cos, radians, atan2, hypot
-from os import makedirs, path
+from bisect import bisect_right
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+import gzip
+from hashlib import sha1
+from itertools import chain, repeat
+import json
+from math import inf, sqrt, cos, radians, atan2, hypot, floor, ceil, log10
+from operator import itemgetter
+from os import getpid, listdir, makedirs, path, remove, replace
 import re
-from time import time, sleep, strftime
+from time import time, strftime
 from sys import stderr
-from typing import Dict, List
 
 import requests
+from requests.adapters import HTTPAdapter, Retry
+try:
+	import orjson  # optional; it decodes big Overpass responses several times faster than json
+except ImportError:
+	orjson = None
 
 
 STYLES = {
@@ -25,6 +36,31 @@ STYLES = {
 	"border": "fill: none; stroke: #a8a8a8; stroke-width: 0.56; stroke-linejoin: round; stroke-linecap: square; stroke-dasharray: 0.01 1.12 0.56 1.12",
 }
 
+OVERPASS_SERVERS = [
+	"https://overpass-api.de/api/interpreter",
+	"https://overpass.kumi.systems/api/interpreter",
+]
+
+BUSY_STATUS_CODES = [429, 502, 503, 504]  # the HTTP errors that mean we should wait and try again
+
+# share one connection pool between all of the requests, and have it wait and retry whenever a server is busy
+SESSION = requests.Session()
+SESSION.headers["User-Agent"] = "User:Justinkunimune's automatic location map replacement script"
+for protocol in ["http://", "https://"]:
+	SESSION.mount(protocol, HTTPAdapter(max_retries=Retry(
+		total=3, backoff_factor=2, status_forcelist=BUSY_STATUS_CODES,
+		allowed_methods=["GET", "POST"], raise_on_status=False)))
+
+CACHE_LIFETIME = 7*24*60*60  # how long to keep reusing OpenStreetMap data, in seconds
+
+CLIPPING_MARGIN = 5  # how far past the edge of the map to keep drawing lines, in millimeters
+
+SIMPLIFICATION_TOLERANCE = 0.02  # how far we can move a line when simplifying it, in millimeters
+
+CONSTRUCTION_KEYS = ["highway", "railway", "landuse"]  # the keys for which we also look for features under construction
+
+UNITS_PER_MM = 100  # the resolution of the SVG coordinates (so that they can all be written as integers)
+
 LAYER_ORDER = [
 	"green", "airport", "airstrip", "sea", "lake", "minor_street", "major_street",
 	"minor_highway", "major_highway", "railroad", "border",
@@ -55,6 +91,12 @@ def main():
 	parser.add_argument(
 		"--border-detail", type=int, default=0,
 		help="The level of detail at which to show political borders: 0 for none, 2 for national, 4 for provincial, and so on")
+	parser.add_argument(
+		"--no-cache", action="store_true",
+		help="Download fresh data from OpenStreetMap even if the same query was made recently")
+	parser.add_argument(
+		"--svgz", action="store_true",
+		help="Save the map as a gzip-compressed SVGZ file, which is much smaller but can't be uploaded to the Wikimedia Commons")
 	args = parser.parse_args()
 
 	try:
@@ -66,9 +108,11 @@ def main():
 			args.border_detail, args.street_detail,
 			args.railroads, args.tramways, args.walkways, args.parks, y_scale)
 
-		data = load_data(bbox, shape_types)
+		data = load_data(bbox, shape_types, not args.no_cache)
+
+		layers = classify(shape_types, data)
 
-		write_SVG(new_filename, bbox, x_scale, y_scale, shape_types, data)
+		write_SVG(new_filename, bbox, x_scale, y_scale, shape_types, layers, data, args.svgz)
 	except Exception as e:
 		print(e, file=stderr)
 
@@ -119,28 +163,31 @@ def choose_bounds(area_specifier):
 
 def choose_bounds_from_wobpage(address):
 	# load the page
-	page = requests.get(address, headers={
-		"User-Agent": "User:Justinkunimune's automatic location map replacement script"
-	})
+	page = SESSION.get(address)
 	if page.status_code != 200:
 		raise FileNotFoundError(f"The page `{address}` doesn't seem to exist.")
-	if "No file by this name exists" in page or "does not have a Module page with this exact name" in page:
+	text = page.text  # (Requests decodes the page again every time you ask for its text, so only do it once)
+	if "No file by this name exists" in text or "does not have a Module page with this exact name" in text:
 		raise FileNotFoundError(f"There doesn't seem to be anything at `{address}`.")
-	# extract the bounding box from the page's content
-	bounds = []
-	for direction in [r"S|south|bottom", r"N|north|top", r"W|west|left", r"E|east|right"]:
-		sentence = re.search(rf"\b({direction})\b[a-z</>\s]*[:=]\s+([-+0-9]+\.[0-9]+)(°[NSEW])?", page.text)
-		if sentence is not None:
-			bound = float(sentence.group(2))
-			units = sentence.group(3)
+	# extract the bounding box from the page's content, looking for all four directions in one pass
+	directions = [r"S|south|bottom", r"N|north|top", r"W|west|left", r"E|east|right"]
+	bounds = [None]*4
+	for sentence in re.finditer(
+			r"\b(?:" + "|".join(f"({direction})" for direction in directions) + r")\b[a-z</>\s]*[:=]\s+([-+0-9]+\.[0-9]+)(°[NSEW])?",
+			text):
+		i = next(k for k in range(4) if sentence.group(k + 1) is not None)  # which direction this is
+		if bounds[i] is None:
+			bound = float(sentence.group(5))
+			units = sentence.group(6)
 			if units is not None and (units == "°S" or units == "°W"):
 				bound *= -1
-			bounds.append(bound)
-		else:
+			bounds[i] = bound
+	for direction, bound in zip(directions, bounds):
+		if bound is None:
 			raise ValueError(f"I can't find the {direction} info on `{address}`.")
 	south, north, west, east = bounds
 
-	sentence = re.search(r"\bimage\b[a-z</>\s]*[:=]\s.*>([^<>/\\]+\.[A-Za-z]+)<", page.text)
+	sentence = re.search(r"\bimage\b[a-z</>\s]*[:=]\s.*>([^<>/\\]+\.[A-Za-z]+)<", text)
 	if sentence is not None:
 		filename = sentence.group(1)
 	else:
@@ -199,30 +246,29 @@ def choose_queries(border_detail, street_detail, railroads, tramways, walkways,
 		show_parks = parks == "yes"
 
 	# put together the tags that define the relevant data
-	shape_types = {
-		"sea": [
-			("nwr", "natural", r"^coastline$"),
-		],
-		"lake": [
-			("nwr", "natural", r"^water$"),
-		],
-		"airport": [
-			("nwr", "aeroway", r"^(aerodrome|airstrip|heliport|launch_complex)$"),
-		],
-	}
+	shape_types = defaultdict(list)
+	shape_types["sea"] += [
+		("nwr", "natural", r"^coastline$"),
+	]
+	shape_types["lake"] += [
+		("nwr", "natural", r"^water$"),
+	]
+	shape_types["airport"] += [
+		("nwr", "aeroway", r"^(aerodrome|airstrip|heliport|launch_complex)$"),
+	]
 	if num_street_layers >= 1:
-		shape_types["major_highway"] = [
+		shape_types["major_highway"] += [
 			("way", "highway", r"^motorway$"),
 		]
 	if num_street_layers >= 2:
-		shape_types["minor_highway"] = [
+		shape_types["minor_highway"] += [
 			("way", "highway", r"^trunk$"),
 		]
 	if num_street_layers >= 3:
-		shape_types["airstrip"] = [
+		shape_types["airstrip"] += [
 			("way", "aeroway", r"^runway$"),
 		]
-		shape_types["major_street"] = [
+		shape_types["major_street"] += [
 			("way", "highway", r"^(primary|(motorway|trunk)_link)$"),
 		]
 	if num_street_layers >= 4:
@@ -230,7 +276,7 @@ def choose_queries(border_detail, street_detail, railroads, tramways, walkways,
 			("way", "highway", r"^secondary$"),
 		]
 	if num_street_layers >= 5:
-		shape_types["minor_street"] = [
+		shape_types["minor_street"] += [
 			("way", "highway", r"^(tertiary|(primary|secondary|tertiary)_link)$"),
 		]
 	if num_street_layers >= 6:
@@ -238,59 +284,172 @@ def choose_queries(border_detail, street_detail, railroads, tramways, walkways,
 			("way", "highway", r"^(unclassified|residential|living_street)$"),
 		]
 	if show_tramways:
-		if "major_street" not in shape_types:
-			shape_types["major_street"] = []
 		shape_types["major_street"] += [
 			("way", "railway", r"^tram$"),
 		]
 	if show_walkways:
-		if "minor_street" not in shape_types:
-			shape_types["minor_street"] = []
 		shape_types["minor_street"] += [
 			("way[area!=yes]", "highway", r"^pedestrian$")
 		]
 	if show_railroads:
-		shape_types["railroad"] = [
+		shape_types["railroad"] += [
 			("way[service!~'(crossover|siding|spur|yard)']", "railway", r"^rail$"),
 		]
 	if show_parks:
-		shape_types["green"] = [
+		shape_types["green"] += [
 			("nwr", "leisure", r"^(park|dog_park|pitch|stadium|golf_course|garden|nature_reserve)$"),
 			("nwr", "natural", r"^(grassland|heath|scrub|tundra|wood|wetland)$"),
 			("nwr", "landuse", r"^(farmland|forest|meadow|orchard|vineyard|cemetery|recreation_ground|village_green)$"),
 			("nwr[boundary=protected_area]", "protect_class", r"^1[ab]?$")
 		]
 	if border_detail != 0:
-		shape_types["border"] = [
+		shape_types["border"] += [
 			("relation[boundary=administrative]", "admin_level", fr"^[1-{border_detail}]$"),
 		]
 
-	return shape_types
+	return dict(shape_types)
 
 
-def load_data(bbox, shape_types):
+def load_data(bbox, shape_types, use_cache):
 	# load relevant data for the relevant region from OpenStreetMap's Overpass API
-	full_query = f"[out:json][timeout:180][bbox:{bbox.south},{bbox.west},{bbox.north},{bbox.east}]; ( "
+	# merge the statements that share a kind and key into one regex alternation so Overpass only has to scan for each once
+	grouped_values = defaultdict(list)
 	for query_set in shape_types.values():
 		for kind, key, values in query_set:
-			full_query += f'{kind}["{key}"~"{values}"]; '
-			if key in ["highway", "railway", "landuse"]:  # don't forget to also query roads under construction
-				full_query += f'{kind}["{key}"="construction"]["construction"~"{values}"]; '
+			if values not in grouped_values[kind, key]:
+				grouped_values[kind, key].append(values)
+	# (rounding the bounds outward so that slightly different maps of the same area can share cached data)
+	query_bbox = snap_bbox(bbox)
+	full_query = f"[out:json][timeout:180][bbox:{query_bbox.south},{query_bbox.west},{query_bbox.north},{query_bbox.east}]; ( "
+	construction_keys = defaultdict(list)
+	construction_values = defaultdict(list)
+	for (kind, key), values_list in grouped_values.items():
+		full_query += f'{kind}["{key}"~"{merge_regexes(values_list)}"]; '
+		if key in CONSTRUCTION_KEYS:  # don't forget to also query roads under construction
+			if key not in construction_keys[kind]:
+				construction_keys[kind].append(key)
+			construction_values[kind] += values_list
+	# get all of those under-construction features with one statement per kind rather than one per key
+	# (only looking at the keys that this kind actually uses, so we don't download construction sites we can't draw)
+	for kind, values_list in construction_values.items():
+		full_query += f'{kind}[~"^({"|".join(construction_keys[kind])})$"~"^construction$"]["construction"~"{merge_regexes(values_list)}"]; '
 	full_query += f"); out geom;"
-	print(f"Loading data from OpenStreetMap...")
+	# if we've made this exact query recently, reuse the response rather than bothering the server again
+	# (the cached responses are gzipped, since JSON compresses so well)
+	cache_filename = f"maps/.cache/{sha1(full_query.encode('utf-8')).hexdigest()}.json.gz"
 	start = time()
-	response = requests.post("https://overpass-api.de/api/interpreter", data={"data": full_query})
-	if response.status_code == 504:
-		raise ValueError(f"The OpenStreetMap server said it was too busy to respond to us (error 504).  Wait a minute and try again.  If the problem persists, the query may be too big, in which case you would need to suppress some map features or reduce the amount of street detail.")
-	elif response.status_code != 200:
-		raise ValueError(f"The OpenStreetMap query failed with error code {response.status_code}.")
+	if use_cache and path.isfile(cache_filename) and time() - path.getmtime(cache_filename) < CACHE_LIFETIME:
+		print(f"Loading data from the cache...")
+		data = read_gzipped_json(cache_filename)
+	else:
+		print(f"Loading data from OpenStreetMap...")
+		# if the main server is too busy, try the other ones before giving up
+		for server in OVERPASS_SERVERS:
+			with SESSION.post(server, data={"data": full_query}, stream=True) as response:
+				if response.status_code in BUSY_STATUS_CODES:
+					print(f"{server} is too busy (error {response.status_code}).")
+					continue
+				elif response.status_code != 200:
+					raise ValueError(f"The OpenStreetMap query failed with error code {response.status_code}.")
+				# stream the response straight into the cache so we never hold the raw text in memory
+				# (via a temporary file so that simultaneous runs can't corrupt it)
+				makedirs("maps/.cache", exist_ok=True)
+				with gzip.open(f"{cache_filename}.{getpid()}.tmp", "wb", compresslevel=3) as file:
+					for chunk in response.iter_content(chunk_size=1 << 20):
+						file.write(chunk)
+			data = read_gzipped_json(f"{cache_filename}.{getpid()}.tmp")
+			# if the query timed out or ran out of memory, the server still says it succeeded but adds a remark;
+			# don't cache that truncated response (or clobber a good one with it), or we'd keep drawing the same broken map
+			if "remark" in data:
+				remove(f"{cache_filename}.{getpid()}.tmp")
+				raise ValueError(f"The OpenStreetMap query didn't finish (\"{data['remark']}\").  Wait a minute and try again.  If the problem persists, the query may be too big, in which case you would need to suppress some map features or reduce the amount of street detail.")
+			replace(f"{cache_filename}.{getpid()}.tmp", cache_filename)
+			break
+		else:
+			raise ValueError(f"The OpenStreetMap servers all said they were too busy to respond to us.  Wait a minute and try again.  If the problem persists, the query may be too big, in which case you would need to suppress some map features or reduce the amount of street detail.")
+		# while we're at it, clear out any responses that have expired so the cache doesn't grow forever
+		# (along with any temporary files left behind by downloads that got interrupted)
+		for old_filename in listdir("maps/.cache"):
+			old_filename = f"maps/.cache/{old_filename}"
+			if old_filename.endswith(".json.gz") or old_filename.endswith(".tmp"):
+				try:
+					if time() - path.getmtime(old_filename) > CACHE_LIFETIME:
+						remove(old_filename)
+				except FileNotFoundError:
+					pass  # another run must have removed it first
 	end = time()
-	data = response.json()
+	# throw out the nodes, which we never draw, and convert the points from dicts to tuples, which are more compact and can be hashed
+	latitude_and_longitude = itemgetter("lat", "lon")
+	shapes = []
+	for shape in data["elements"]:
+		if shape["type"] == "node":
+			continue
+		if "geometry" in shape:
+			shape["geometry"] = list(map(latitude_and_longitude, shape["geometry"]))
+		if "members" in shape:
+			for member in shape["members"]:
+				if "geometry" in member:
+					member["geometry"] = list(map(latitude_and_longitude, member["geometry"]))
+		shapes.append(shape)
+	data["elements"] = shapes
 	print(f"Loaded {len(data['elements'])} shapes in {end - start:.0f} seconds.")
 	return data
 
 
-def write_SVG(new_filename, bbox, x_scale, y_scale, shape_types, data):
+def read_gzipped_json(filename):
+	with gzip.open(filename, "rb") as file:
+		if orjson is not None:
+			return orjson.loads(file.read())
+		else:
+			return json.load(file)
+
+
+def classify(shape_types, data):
+	# figure out which layer each shape belongs in, in the order the layers will be drawn
+	# prepare the tag value filters ahead of time, merging the ones in each layer that look at the same key
+	matchers = {}
+	for shape_type, query_set in shape_types.items():
+		grouped_values = defaultdict(list)
+		for kind, key, values in query_set:
+			grouped_values[key].append(values)
+		matchers[shape_type] = {
+			key: tag_matcher(merge_regexes(values_list)) for key, values_list in grouped_values.items()}
+
+	# sort the shapes by tag so that each layer only has to check each distinct tag value once
+	# (under construction features are also sorted by what they will be, so they can be checked the same way)
+	shapes_by_tag = defaultdict(lambda: defaultdict(list))
+	shapes_under_construction_by_tag = defaultdict(lambda: defaultdict(list))
+	relevant_keys = {key for query_set in shape_types.values() for kind, key, values in query_set}
+	relevant_construction_keys = relevant_keys.intersection(CONSTRUCTION_KEYS)
+	for shape in data["elements"]:
+		tags = shape["tags"]
+		for key in relevant_keys.intersection(tags):
+			shapes_by_tag[key][tags[key]].append(shape)
+		if "construction" in tags:
+			for key in relevant_construction_keys.intersection(tags):
+				if tags[key] == "construction":
+					shapes_under_construction_by_tag[key][tags["construction"]].append(shape)
+
+	# sort the shapes into layers
+	layers = {}
+	for shape_type in filter(shape_types.__contains__, LAYER_ORDER):
+		# pull out the shapes that belong to that particular type
+		shapes = []
+		for key, matches in matchers[shape_type].items():
+			for value, shapes_with_value in shapes_by_tag[key].items():
+				if matches(value):
+					shapes += shapes_with_value
+			if key in CONSTRUCTION_KEYS and not matches("construction"):  # don't forget to also get the under construction features
+				for value, shapes_with_value in shapes_under_construction_by_tag[key].items():
+					if matches(value):
+						shapes += shapes_with_value
+		if len(shapes) > 0:
+			layers[shape_type] = shapes
+
+	return layers
+
+
+def write_SVG(new_filename, bbox, x_scale, y_scale, shape_types, layers, data, compress):
 	# compose the description
 	sources = {"the OpenStreetMap contributors"}
 	for shape in data["elements"]:
@@ -305,128 +464,247 @@ def write_SVG(new_filename, bbox, x_scale, y_scale, shape_types, data):
 		f'under the <a href="https://opendatacommons.org/licenses/odbl/1-0/">Open Database License</a>.  '
 		f'It was accessed on {strftime("%Y %b %d")}.  The map itself was generated by '
 		f'<a href="https://github.com/jkunimune/auto-location-map">a Python script written by Justin Kunimune</a>.')
-	description = re.sub(r"([0-9]),([0-9])", "\\1 \\2", description)  # use spaces for thousands grouping
-	description = re.sub(r" -([0-9])", " −\\1", description)  # use unicode minus symbol
+	description = re.sub(  # use spaces for thousands grouping and the unicode minus symbol
+		r"(?<=[0-9]),(?=[0-9])| -(?=[0-9])", lambda match: " " if match.group() == "," else " −", description)
 	wikitext_description = re.sub(r'<a href="([^"]+)">([^<]+)</a>', '[\\1 \\2]', description)
 	print(f"Recommended description:\n\t{wikitext_description}")
 
 	# compose the stylesheet
-	stylesheet = f"\t\t.background {{ {STYLES['background']} }}\n"
-	for shape_type in shape_types:
-		stylesheet += f"\t\t.{shape_type} {{ {STYLES[shape_type]} }}\n"
-	# choose the line thicknesses
+	stylesheet = "".join(
+		f"\t\t.{shape_type} {{ {STYLES[shape_type]} }}\n" for shape_type in ["background", *shape_types])
+	# choose the line thicknesses, giving the thinnest one to the lowest rank that's actually used
 	thicknesses = [1.12, 0.84, 0.56, 0.35]
-	for i in range(4):
-		if f"«{i}»" in stylesheet:
-			stylesheet = stylesheet.replace(f"«{i}»", f"{thicknesses.pop()}")
-
-	# write the file
+	ranks_used = sorted(set(re.findall(r"«([0-9])»", stylesheet)))
+	rank_thicknesses = {rank: thicknesses.pop() for rank in ranks_used}
+	stylesheet = re.sub(r"«([0-9])»", lambda match: f"{rank_thicknesses[match.group(1)]}", stylesheet)
+	# convert the line dimensions from millimeters to SVG units
+	stylesheet = re.sub(
+		r"((stroke-width|stroke-dasharray): )([0-9.]+( [0-9.]+)*)",
+		lambda match: match.group(1) + " ".join(f"{UNITS_PER_MM*float(length):g}" for length in match.group(3).split()),
+		stylesheet)
+
+	# convert the data to SVG
 	print("Writing the SVG file...")
 	width = x_scale*(bbox.east - bbox.west)
 	height = y_scale*(bbox.south - bbox.north)
+	# compose the header
+	header = (
+		f'<?xml version="1.0" encoding="UTF-8"?>\n'
+		f'<svg xmlns="http://www.w3.org/2000/svg" width="{width:.2f}mm" height="{height:.2f}mm" viewBox="0 0 {UNITS_PER_MM*width:.0f} {UNITS_PER_MM*height:.0f}">\n'
+		f'\t<title>{new_filename}</title>\n'
+		f'\t<desc>\n\t\t{description}\n\t</desc>\n'
+		f'\t<style>\n{stylesheet}\t</style>\n'
+		f'\t<rect class="background" x="0" y="0" width="100%" height="100%" />\n'
+	)
+
+	# write the file, streaming each layer to disk as soon as it's ready rather than holding the whole document in memory
+	# (via a temporary file so that a failure partway through doesn't leave a broken map behind)
+	extension = "svgz" if compress else "svg"
 	makedirs("maps", exist_ok=True)
-	with open(f"maps/{new_filename}.svg", "w", encoding="utf-8") as file:
-		# write the header
-		file.write(
-			f'<?xml version="1.0" encoding="UTF-8"?>\n'
-			f'<svg xmlns="http://www.w3.org/2000/svg" width="{width:.2f}mm" height="{height:.2f}mm" viewBox="0 0 {width:.2f} {height:.2f}">\n'
-			f'\t<title>{new_filename}</title>\n'
-			f'\t<desc>\n\t\t{description}\n\t</desc>\n'
-			f'\t<style>\n{stylesheet}\t</style>\n'
-			f'\t<rect class="background" x="0" y="0" width="100%" height="100%" />\n'
-		)
-
-		# for each type of data, in order
-		for shape_type in LAYER_ORDER:
-			if shape_type not in shape_types:
-				continue
+	temporary_filename = f"maps/{new_filename}.{extension}.{getpid()}.tmp"
+	if compress:
+		file = gzip.open(temporary_filename, "wt", encoding="utf-8", compresslevel=6)
+	else:
+		file = open(temporary_filename, "w", encoding="utf-8")
+	try:
+		with file:
+			file.write(header)
+			# the layers are independent of each other, so process them in parallel
+			# (sending only their geometry to the other processes, since the rest would just slow down the pickling)
+			with ProcessPoolExecutor() as executor:
+				for layer in executor.map(
+						compose_layer, layers.keys(), (extract_paths(shapes, bbox) for shapes in layers.values()),
+						repeat(bbox), repeat(x_scale), repeat(y_scale)):
+					file.write(layer)
+			file.write("</svg>\n")
+	except BaseException:
+		remove(temporary_filename)  # don't leave the half-written map lying around
+		raise
+	replace(temporary_filename, f"maps/{new_filename}.{extension}")
+	print(f"Saved the map to `maps/{new_filename}.{extension}`!")
+
+
+def extract_paths(shapes, bbox):
+	# pull out the geometry, leaving behind the tags and everything else we don't need for drawing
+	paths = []
+	for shape in shapes:
+		if shape["type"] == "way":  # skip any that were only loaded because the query's bounds are a bit bigger than the map
+			if might_be_in_bounds(shape["geometry"], bbox):
+				paths.append([shape["geometry"]])
+		elif shape["type"] == "relation":  # for relations pull out the members, skipping any that are nowhere near the map
+			path = []
+			for member in shape["members"]:
+				if "geometry" in member:
+					if might_be_in_bounds(member["geometry"], bbox):
+						path.append(member["geometry"])
+			paths.append(path)
+		else:
+			raise TypeError(shape["type"])
+	return paths
 
-			# pull out the shapes that belong to that particular type
-			shapes = []
-			for shape in data["elements"]:
-				if shape["type"] != "node":
-					for kind, key, values in shape_types[shape_type]:
-						if key in shape["tags"]:
-							if re.match(values, shape["tags"][key]) is not None:
-								shapes.append(shape)
-							elif shape["tags"][key] == "construction":  # don't forget to also get the under construction features
-								if "construction" in shape["tags"] and re.match(values, shape["tags"]["construction"]) is not None:
-									shapes.append(shape)
-			if len(shapes) == 0:
-				continue
 
-			# pull out the geometry and post-process it into nice polygons
-			paths = []
-			for shape in shapes:
-				if shape["type"] == "way":
-					paths.append([shape["geometry"]])
-				elif shape["type"] == "relation":  # for relations pull out the members and make sure it's in bounds
-					path = []
-					for member in shape["members"]:
-						if "geometry" in member:
-							if any_in_bounds(member["geometry"], bbox):
-								path.append(member["geometry"])
-					paths.append(path)
-				else:
-					raise TypeError(shape["type"])
-			# stitch the loaded paths together as necessary
-			if shape_type == "sea":  # for coastlines this is especially involved
-				paths = close_polygon(consolidate_all_polygons(paths), bbox)
-			elif shape_type == "border":
-				paths = consolidate_all_polygons(purge_duplicate_paths(paths))
-			elif "fill: none" in STYLES[shape_type]:
-				paths = consolidate_all_polygons(paths)
+def compose_layer(shape_type, paths, bbox, x_scale, y_scale):
+	# stitch the loaded paths together as necessary
+	if shape_type == "sea":  # for coastlines this is especially involved
+		paths = close_polygon(consolidate_all_polygons(paths), bbox)
+	elif shape_type == "border":
+		paths = consolidate_all_polygons(purge_duplicate_paths(paths))
+	elif "fill: none" in STYLES[shape_type]:
+		paths = consolidate_all_polygons(paths)
+	else:
+		paths = purge_small_polygons(consolidate_multipolygons(paths), x_scale, y_scale)
+
+	# convert it to SVG paths
+	# (the projection is affine, so work out its coefficients once here rather than for every point)
+	x_slope, x_intercept = UNITS_PER_MM*x_scale, -UNITS_PER_MM*x_scale*bbox.west
+	y_slope, y_intercept = UNITS_PER_MM*y_scale, -UNITS_PER_MM*y_scale*bbox.north
+	# lines can be cut off a little ways past the edge of the map (areas can't, since that would mess up their fill)
+	if "fill: none" in STYLES[shape_type]:
+		margin = UNITS_PER_MM*CLIPPING_MARGIN
+		clipping_box = (
+			-margin, x_slope*bbox.east + x_intercept + margin,
+			-margin, y_slope*bbox.south + y_intercept + margin)
+	else:
+		clipping_box = None
+	layer = [f'\t<g class="{shape_type}">\n']
+	for path in paths:
+		path_string = []
+		for segment in path:
+			# project the whole segment at once, then format it
+			# (after the initial M, the remaining points are implicitly L commands)
+			points = [(round(x_slope*lon + x_intercept), round(y_slope*lat + y_intercept)) for lat, lon in segment]
+			# skip any points that round to the same place as the one before them
+			points = [point for point, previous in zip(points, [None] + points) if point != previous]
+			if len(points) < 2:
+				continue
+			# and any parts of lines that are nowhere near the map
+			if clipping_box is not None:
+				pieces = clip_to_box(points, *clipping_box)
 			else:
-				paths = purge_small_polygons(consolidate_multipolygons(paths), x_scale, y_scale)
-
-			# convert it to SVG paths
-			file.write(f'\t<g class="{shape_type}">\n')
-			for path in paths:
-				path_string = ""
-				for segment in path:
-					for i, point in enumerate(segment):
-						command = "M" if i == 0 else "L"
-						x = x_scale*(point["lon"] - bbox.west)
-						y = y_scale*(point["lat"] - bbox.north)
-						path_string += f"{command}{x:.2f},{y:.2f} "
-				file.write(f'\t\t<path d="{path_string}" />\n')
-			file.write(f'\t</g>\n')
-		file.write("</svg>\n")
-	print(f"Saved the map to `maps/{new_filename}.svg`!")
+				pieces = [points]
+			for piece in pieces:
+				# and skip any that are too close to the line through their neighbors to make a visible difference
+				piece = simplify(piece, UNITS_PER_MM*SIMPLIFICATION_TOLERANCE)
+				# format them all with a single template rather than one f-string per point
+				# (closing the loop with a Z rather than by repeating the first point, if it's a loop)
+				if len(piece) > 2 and piece[0] == piece[-1]:
+					path_string.append(("M%d,%d " + "%d,%d "*(len(piece) - 2) + "Z ") % tuple(chain.from_iterable(piece[:-1])))
+				else:
+					path_string.append(("M%d,%d " + "%d,%d "*(len(piece) - 1)) % tuple(chain.from_iterable(piece)))
+		if len(path_string) > 0:
+			layer.append(f'\t\t<path d="{"".join(path_string)}" />\n')
+	layer.append(f'\t</g>\n')
+	return "".join(layer)
+
+
+def clip_to_box(points, x_min, x_max, y_min, y_max):
+	# break a line into the parts that come near the given box, leaving out everything in between
+	pieces = []
+	piece = []
+	for (x0, y0), (x1, y1) in zip(points[:-1], points[1:]):
+		# keep every edge whose own bounding box overlaps this one (which is conservative, but quick)
+		if max(x0, x1) >= x_min and min(x0, x1) <= x_max and max(y0, y1) >= y_min and min(y0, y1) <= y_max:
+			if len(piece) == 0:
+				piece.append((x0, y0))
+			piece.append((x1, y1))
+		elif len(piece) > 0:
+			pieces.append(piece)
+			piece = []
+	if len(piece) > 0:
+		pieces.append(piece)
+	return pieces
+
+
+def simplify(points, tolerance):
+	# remove points until the line would move by more than the tolerance, using the Douglas–Peucker algorithm
+	keep = [False]*len(points)
+	keep[0] = keep[-1] = True
+	sections = [(0, len(points) - 1)]
+	while len(sections) > 0:
+		start, end = sections.pop()
+		(x0, y0), (x1, y1) = points[start], points[end]
+		length = hypot(x1 - x0, y1 - y0)
+		# find the point farthest from the line between this section's endpoints
+		farthest, max_distance = None, tolerance
+		for i in range(start + 1, end):
+			x, y = points[i]
+			if length > 0:
+				distance = abs((x1 - x0)*(y0 - y) - (x0 - x)*(y1 - y0))/length
+			else:  # (if the endpoints are the same, as they are for closed segments, use the distance to that point)
+				distance = hypot(x - x0, y - y0)
+			if distance > max_distance:
+				farthest, max_distance = i, distance
+		# if it's too far to drop, keep it and check the sections on either side of it
+		if farthest is not None:
+			keep[farthest] = True
+			sections.append((start, farthest))
+			sections.append((farthest, end))
+	return [point for point, kept in zip(points, keep) if kept]
 
 
 def consolidate_multipolygons(paths):
 	finished_paths = []
 	for path in paths:
-		finished_segments = []
-		pending_segments = path[:]
+		# most areas are just one closed way (or several), in which case there's nothing to stitch
+		if all(segment[0] == segment[-1] for segment in path):
+			finished_paths.append(list(path))
+			continue
+		# give each segment an ID so that it can be removed from wherever it is without searching
+		finished_segments = {}
+		pending_segments = dict(enumerate(path))
+		next_id = len(path)
+		# index the open segments by their endpoints so we can find neighbors without searching
+		starts = defaultdict(list)
+		ends = defaultdict(list)
+		for i, segment in pending_segments.items():
+			if segment[0] != segment[-1]:
+				starts[segment[0]].append(i)
+				ends[segment[-1]].append(i)
 		while len(pending_segments) > 0:
 			# examine an arbitrary open segment
-			last_segment = pending_segments.pop()
+			i, last_segment = pending_segments.popitem()
 			# if it's already closed, we're done here
 			if last_segment[0] == last_segment[-1]:
-				finished_segments.append(last_segment)
+				finished_segments[i] = last_segment
 				continue
-			# otherwise, search for another segment that starts or ends with its endpoint
-			next_segment = None
-			for segments in [pending_segments, finished_segments]:
-				for i in range(len(segments)):
-					if segments[i][0] == last_segment[-1]:
-						next_segment = segments.pop(i)
-						break
-					elif segments[i][-1] == last_segment[-1]:
-						next_segment = segments.pop(i)[::-1]
-						break
-				if next_segment is not None:
-					break
+			starts[last_segment[0]].remove(i)
+			ends[last_segment[-1]].remove(i)
+			# otherwise, look up another segment that starts or ends with its endpoint
+			endpoint = last_segment[-1]
+			if len(starts[endpoint]) > 0:
+				j = starts[endpoint][-1]
+			elif len(ends[endpoint]) > 0:
+				j = ends[endpoint][-1]
+			else:
+				j = None
 			# if no one starts with its endpoint, consider it finalized for now
-			if next_segment is None:
-				finished_segments.append(last_segment)
+			if j is None:
+				finished_segments[i] = last_segment
+				starts[last_segment[0]].append(i)
+				ends[endpoint].append(i)
 			# if you found another one that starts with its endpoint, stick them together and add that to the queue
 			else:
-				pending_segments.append(last_segment + next_segment)
+				if j in pending_segments:
+					next_segment = pending_segments.pop(j)
+				else:
+					next_segment = finished_segments.pop(j)
+				starts[next_segment[0]].remove(j)
+				ends[next_segment[-1]].remove(j)
+				if next_segment[0] != endpoint:
+					next_segment = next_segment[::-1]
+				# (segments that we made ourselves can be extended in place, which keeps long chains from being copied over and over)
+				if i >= len(path):
+					new_segment = last_segment
+					new_segment += next_segment
+				else:
+					new_segment = last_segment + next_segment
+				pending_segments[next_id] = new_segment
+				if new_segment[0] != new_segment[-1]:
+					starts[new_segment[0]].append(next_id)
+					ends[new_segment[-1]].append(next_id)
+				next_id += 1
 		# when you run out of segments, you're done
-		finished_paths.append(finished_segments)
+		finished_paths.append(list(finished_segments.values()))
 	return finished_paths
 
 
@@ -438,46 +716,46 @@ def consolidate_all_polygons(paths):
 
 def close_polygon(paths, bbox):
 	# define this little utility function real quick
-	def angular_distance(point_A, point_B):
-		θ_A = atan2(
-			point_A["lat"] - (bbox.north + bbox.south)/2,
-			point_A["lon"] - (bbox.east + bbox.west)/2)
-		θ_B = atan2(
-			point_B["lat"] - (bbox.north + bbox.south)/2,
-			point_B["lon"] - (bbox.east + bbox.west)/2)
-		if θ_A >= θ_B:
-			return θ_A - θ_B
-		else:
-			return θ_A - θ_B + 2*pi
+	center_lat, center_lon = (bbox.north + bbox.south)/2, (bbox.east + bbox.west)/2
+	def angle(point):
+		return atan2(point[0] - center_lat, point[1] - center_lon)
 
 	# first, add the corners to the set of segments to stitch together
 	open_segments = [
-		[{"lat": bbox.north, "lon": bbox.east}],
-		[{"lat": bbox.north, "lon": bbox.west}],
-		[{"lat": bbox.south, "lon": bbox.east}],
-		[{"lat": bbox.south, "lon": bbox.west}],
+		[(bbox.north, bbox.east)],
+		[(bbox.north, bbox.west)],
+		[(bbox.south, bbox.east)],
+		[(bbox.south, bbox.west)],
 	] + [path[0] for path in paths]
 	# pull out any segments that are already closed
 	closed_segments = []
 	for i in reversed(range(4, len(open_segments) - 1)):
 		if open_segments[i][0] == open_segments[i][-1]:
 			closed_segments.append(open_segments.pop(i))
+	# sort the open segments by the direction of their start points from the center (ties go to the earlier segment)
+	all_start_angles = [angle(segment[0]) for segment in open_segments]
+	start_indices = sorted(range(len(open_segments)), key=lambda i: (all_start_angles[i], -i))
+	start_angles = [all_start_angles[i] for i in start_indices]
+	is_open = [True]*len(open_segments)
 	# then, pull off arbitrary open segments and try to complete them
-	while len(open_segments) > 0:
-		new_closed_segment = open_segments[-1]
+	last = len(open_segments) - 1
+	while last >= 0:
+		if not is_open[last]:
+			last -= 1
+			continue
+		new_closed_segment = open_segments[last]
 		while True:
-			next_segment = min(
-				open_segments,
-				key=lambda segment: angular_distance(new_closed_segment[-1], segment[0])
-			)
-			if next_segment == new_closed_segment:
-				open_segments.remove(new_closed_segment)
+			# the next segment is whichever one starts soonest clockwise from where this one ends
+			k = bisect_right(start_angles, angle(new_closed_segment[-1])) - 1
+			next_index = start_indices.pop(k)
+			start_angles.pop(k)
+			is_open[next_index] = False
+			if next_index == last:
 				if len(new_closed_segment) > 1:
 					closed_segments.append(new_closed_segment)
 				break
 			else:
-				open_segments.remove(next_segment)
-				new_closed_segment += next_segment
+				new_closed_segment += open_segments[next_index]
 
 	return [closed_segments]
 
@@ -485,49 +763,145 @@ def close_polygon(paths, bbox):
 def purge_duplicate_paths(paths):
 	# first, dump all of the path parts into one bin of path parts
 	paths = list(chain(*paths))
-	# then look for identical path parts
-	for i in reversed(range(len(paths))):
-		for j in range(i):
-			if paths[i] == paths[j]:
-				paths.pop(i)
-				break
+	# then look for identical path parts (in either direction), keeping only the first of each
+	unique_paths = []
+	seen = set()
+	for path in paths:
+		key = tuple(path)
+		if key not in seen:
+			seen.add(key)
+			seen.add(key[::-1])
+			unique_paths.append(path)
 	# then run a quick consolidation algorithm on what's left
-	return [[path] for path in paths]
+	return [[path] for path in unique_paths]
 
 
 def purge_small_polygons(paths, x_scale, y_scale):
 	# remove paths that have very small bounding boxen
 	for i in reversed(range(len(paths))):
-		path = paths[i]
-		x_min, x_max = inf, -inf
-		y_min, y_max = inf, -inf
-		for part in path:
-			for point in part:
-				x = x_scale*point["lon"]
-				y = y_scale*point["lat"]
-				if x < x_min:
-					x_min = x
-				if x > x_max:
-					x_max = x
-				if y < y_min:
-					y_min = y
-				if y > y_max:
-					y_max = y
-		size = hypot(x_max - x_min, y_max - y_min)
-		if size < 1:
+		if is_small(paths[i], x_scale, y_scale):
 			paths.pop(i)
 	return paths
 
 
-def any_in_bounds(points, bbox):
-	for point in points:
-		if bbox.south <= point["lat"] <= bbox.north:
-			if bbox.west <= point["lon"] <= bbox.east:
+def is_small(path, x_scale, y_scale):
+	x_min, x_max = inf, -inf
+	y_min, y_max = inf, -inf
+	for part in path:
+		for lat, lon in part:
+			x = x_scale*lon
+			y = y_scale*lat
+			if x < x_min:
+				x_min = x
+			if x > x_max:
+				x_max = x
+			if y < y_min:
+				y_min = y
+			if y > y_max:
+				y_max = y
+			# stop as soon as it's clearly big enough
+			if x_max - x_min >= 1 or y_max - y_min >= 1:
+				return False
+	size = hypot(x_max - x_min, y_max - y_min)
+	return size < 1
+
+
+def merge_regexes(values_list):
+	# combine several anchored regexes into one that matches anything any of them would
+	if len(values_list) == 1:
+		return values_list[0]
+	else:
+		return "^(" + "|".join(strip_group(re.sub(r"^\^|\$$", "", values)) for values in values_list) + ")$"
+
+
+def strip_group(regex):
+	# remove the parentheses around a regex if they enclose the whole thing, since the alternation we put it in is already a group
+	if not (regex.startswith("(") and regex.endswith(")")):
+		return regex
+	depth = 0
+	for i, character in enumerate(regex):
+		if character == "(":
+			depth += 1
+		elif character == ")":
+			depth -= 1
+			if depth == 0 and i < len(regex) - 1:
+				return regex  # the first group closes before the end, so they're not the same parentheses
+	return regex[1:-1]
+
+
+def tag_matcher(values):
+	# most of the tag filters just list out a few permissible values, in which case a set lookup does the job
+	parsing = re.fullmatch(r"\^(.*)\$", values)
+	if parsing is not None:
+		permissible_values = list_alternatives(parsing.group(1))
+		if permissible_values is not None:
+			return frozenset(permissible_values).__contains__
+	# otherwise fall back to the regular expression
+	return re.compile(values).match
+
+
+def list_alternatives(regex):
+	# expand a regex made only of word characters, character sets, groups, alternation, and optional parts
+	# into the set of strings it matches (or return None if it uses anything else)
+	stack = []
+	finished, current, previous = set(), {""}, None
+	for token in re.findall(r"\[[^\]]*\]|.", regex):
+		if token == "(":
+			stack.append((finished, current))
+			finished, current, previous = set(), {""}, None
+		elif token == "|":
+			finished |= current
+			current, previous = {""}, None
+		elif token == ")":
+			if len(stack) == 0:
+				return None
+			group = finished | current
+			finished, previous = stack.pop()
+			current = {prefix + option for prefix in previous for option in group}
+		elif token == "?":  # an optional part means we can also use what we had before it
+			if previous is None:
+				return None
+			current, previous = current | previous, None
+		elif re.fullmatch(r"\w", token):
+			current, previous = {prefix + token for prefix in current}, current
+		elif re.fullmatch(r"\[(\w-\w|\w)+\]", token):
+			options = set()
+			for start, end in re.findall(r"(\w)(?:-(\w))?", token):
+				options |= {chr(code) for code in range(ord(start), ord(end or start) + 1)}
+			current, previous = {prefix + option for prefix in current for option in options}, current
+		else:
+			return None
+	if len(stack) > 0:
+		return None
+	return finished | current
+
+
+def snap_bbox(bbox):
+	# round the bounds outward to a grid whose spacing is between a tenth and a hundredth of the map's smaller dimension
+	digits = 1 - floor(log10(min(bbox.north - bbox.south, bbox.east - bbox.west)))
+	step = 10**-digits
+	return BoundingBox(
+		round(floor(bbox.south/step)*step, digits), round(ceil(bbox.north/step)*step, digits),
+		round(floor(bbox.west/step)*step, digits), round(ceil(bbox.east/step)*step, digits))
+
+
+def might_be_in_bounds(points, bbox):
+	south, north, west, east = bbox.south, bbox.north, bbox.west, bbox.east
+	# usually one of the points will be in bounds
+	for lat, lon in points:
+		if south <= lat <= north:
+			if west <= lon <= east:
 				return True
-	return False
+	# but a long straight line could still cross the map with all of its points outside, so check its extent too
+	if len(points) == 0:
+		return False
+	lats, lons = zip(*points)
+	return min(lats) <= north and max(lats) >= south and min(lons) <= east and max(lons) >= west
 
 
 class BoundingBox:
+	__slots__ = ("south", "north", "west", "east")
+
 	def __init__(self, south, north, west, east):
 		self.south = south
 		self.north = north